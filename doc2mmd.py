@@ -4,8 +4,10 @@ import argparse
 import logging
 import os
 import re
+import struct
 import sys
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copy2, rmtree
 from subprocess import check_call
 
@@ -22,6 +24,32 @@ pandoc = os.path.join(thisdir, r"..\Pandoc\pandoc.exe")
 magick = os.path.join(thisdir, r"..\imagemagick\magick.exe")
 mmd2doc = os.path.join(thisdir, r"mmd2doc.py")
 
+# Precompiled patterns used by the conversion and cleanup passes
+# Quoted ('embeddings/...') or markdown link ](embeddings/...) references
+_RE_EMBED = re.compile(r"""([\'"])(embeddings)/([^\'"]+)|(\]\()(embeddings)/([^\)]+)""")
+_RE_IMG_SPLIT = re.compile(
+    r"(?s)(!\[(?:[^\]]+)?\]\((?:\./)?media/[\w\.]+\.\w+\)(?:\{.*?\})?)"
+)
+_RE_IMG_DIMS = re.compile(r'(?s)media/(.*)\).*width="(\S+?)in.*height="(\S+?)in')
+_RE_IMG_PATH = re.compile(r"(?s)media/(.*)\)")
+_RE_VECTOR_IMG = re.compile(r"(?i)\.[ew]mf$")
+_RE_MEDIA_LEFT = re.compile(r"(?m)^(.*\(media/.*\.png\)).*$")
+_RE_ENTITIES = re.compile(r"&#(?:160|169|174|8209|8211|8216|8217|8220|8221|8230);")
+_RE_SPAN_TAG = re.compile(r"<span[^>]*>|</span>")
+_RE_COMMENT = re.compile(r"(?sm)<!--\s*-->")
+_RE_MATH = re.compile(r"(\$\$.*?\$\$)")
+_RE_ESC_US = re.compile(r"(\w)\\_")
+_RE_ESC_IDX = re.compile(r"\\\[(\d+\:\d+)\\\]")
+_RE_ESC_TILDE = re.compile(r"\\~")
+# TODO: regex to tolerate nested tables
+_RE_TABLE_SPLIT = re.compile(r"(?s)(<table>.*?</table>)")
+_RE_ROWSPAN = re.compile(r"""(?i)rowspan\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*))""")
+_RE_EMPTY_OL = re.compile(r"(?m)^\d+\.\s*$")
+_RE_EMPTY_UL = re.compile(r"(?m)^-\s*$")
+_RE_EMPTY_TBL = re.compile(r"(?ms)^\s*\n(?:\s+-+)+\n\s*\n(?:\s+-+)+\n\s*$")
+_RE_EOL_WS = re.compile(r"(?m)\s+\n")
+_RE_BLANKS = re.compile(r"\n{3,}")
+
 # To make imagemagick happy we must set up the MAGICK_CONFIGURE_PATH
 my_env = os.environ
 magick_path = os.path.abspath(os.path.join(thisdir, r"..\imagemagick"))
@@ -83,28 +111,36 @@ def move_embeddings(md_text, dirname):
 
     logger.info("Moving embeddings")
 
-    moved_files = {}
+    moved_files = {}  # filename -> new path, or None if the move failed
+    made_dirs = set()  # folders under assets known to exist
 
     def move2assets(m):
         # m - match object from the re.sub; return updated path
-        quote, path, filename = m.groups()
+        if m.group(1) is not None:
+            prefix, path, filename = m.group(1, 2, 3)
+        else:
+            prefix, path, filename = m.group(4, 5, 6)
         if filename not in moved_files:
             fro = "%s/%s" % (path, filename)
             to = "assets/%s" % (filename)
             if not os.path.exists(fro):
                 raise Exception("Referenced file '%s' not found" % fro)
             try:
-                if os.path.exists(to):
-                    os.unlink(to)
-                os.rename(fro, to)
+                todir = os.path.dirname(to)
+                if todir not in made_dirs:
+                    os.makedirs(todir, exist_ok=True)
+                    made_dirs.add(todir)
+                # Overwrites an existing file in one call
+                os.replace(fro, to)
+                moved_files[filename] = to
             except OSError:
                 logger.warning("Failed to move %s to %s" % (fro, to))
-                return m.group(0)
-            moved_files[filename] = "%sassets/%s" % (quote, filename)
-        return moved_files[filename]
+                moved_files[filename] = None
+        if moved_files[filename] is None:
+            return m.group(0)
+        return prefix + moved_files[filename]
 
-    md_text = re.sub(r'([\'"])(embeddings)/([^\'"]+)', move2assets, md_text)
-    md_text = re.sub(r"(\]\()(embeddings)/([^\)]+)", move2assets, md_text)
+    md_text = _RE_EMBED.sub(move2assets, md_text)
 
     try:
         os.rmdir("embeddings")
@@ -114,6 +150,127 @@ def move_embeddings(md_text, dirname):
     return md_text
 
 
+def _parse_image(img_str):
+    """
+    Return (filename, max width, max height) for a markdown image reference
+    """
+    m = _RE_IMG_DIMS.search(img_str)
+    if m:
+        fnimg, w_in, h_in = m.groups(1)
+    else:
+        fnimg, w_in, h_in = _RE_IMG_PATH.search(img_str).group(1), 10, 10
+    ppi = 300  # Typical printer
+    # Maximum size we need our images to be
+    w_px, h_px = int(float(w_in) * ppi), int(float(h_in) * ppi)
+    return fnimg, w_px, h_px
+
+
+def _asset_ref(img_str, fnout):
+    # Point an image reference at its converted file in assets. The size
+    # attributes only applied to the original, so they are dropped
+    alt = img_str[2 : img_str.index("]")]
+    return "![%s](assets/%s)" % (alt, fnout)
+
+
+def _read_png_size(path):
+    """
+    Return (width, height) from the PNG IHDR chunk, or None if not a PNG
+    """
+    with open(path, "rb") as f:
+        data = f.read(24)
+    if len(data) < 24 or data[:8] != b"\x89PNG\r\n\x1a\n" or data[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", data[16:24])
+
+
+def _convert_one(fnimg, w_px, h_px, dirname):
+    """
+    Convert a single (non-vector) image with imagemagick, to at most w_px x h_px,
+    and return the name of the file written to assets (None on failure). Safe to
+    run from a worker thread.
+    """
+    fnpng = os.path.splitext(fnimg)[0] + ".png"
+    fnjpg = os.path.splitext(fnimg)[0] + ".jpg"
+    media_src = os.path.join(dirname, "media", fnimg)
+    asset_dst = os.path.join(dirname, "assets", fnpng)
+    asset_jpg = os.path.join(dirname, "assets", fnjpg)
+    try:
+        # Resize, write the png and report the resulting size in one run
+        size = (
+            util.check_output_text(
+                [
+                    magick,
+                    "media/%s" % fnimg,
+                    "-resize",
+                    "%dx%d>" % (w_px, h_px),
+                    "-write",
+                    "assets/%s" % fnpng,
+                    "-format",
+                    "%w %h",
+                    "info:",
+                ],
+                env=my_env,
+                cwd=dirname,
+            )
+            .strip()
+            .split()
+        )
+    except Exception as e:
+        print("-E- Unable to convert %s to png: %s" % (fnimg, e))
+        return None
+    orig_filesz = os.stat(media_src).st_size
+    filesz = os.stat(asset_dst).st_size
+    if (fnimg.endswith("png") or fnimg.endswith("tmp")) and filesz > orig_filesz:
+        # Just copy over the PNG if size increased
+        copy2(media_src, asset_dst)
+        filesz = orig_filesz
+        size = _read_png_size(asset_dst)
+        if size is None:
+            # Not a real PNG (e.g. a copied over .tmp file), ask imagemagick
+            ii = (
+                util.check_output_text(
+                    [magick, "identify", "assets/%s" % fnpng], env=my_env, cwd=dirname
+                )
+                .strip()
+                .split()
+            )
+            # image151.png PNG 3000x2250 3000x2250+0+0 8-bit sRGB 2.145MB 0.000u ...
+            size = ii[2].split("x")
+
+    # Check if PNG format makes sense for large files. Some are better converted to JPG
+    fnout = fnpng
+    w, h = list(map(int, size))
+    n_bytes_raw = w * h * 3
+    comp_ratio = 1.0 * n_bytes_raw / filesz
+    logger.debug(
+        "%s: %dkB, compression ratio: %.1f" % (fnpng, filesz / 1024, comp_ratio)
+    )
+    if filesz > 100000 and comp_ratio < 50:
+        # Big poorly compressed file - see if that's justified
+        logger.debug("Candidate image for compression: %s" % fnpng)
+        check_call(
+            [
+                magick,
+                "assets/%s" % fnpng,
+                "-resize",
+                "1200>",
+                "assets/%s" % fnjpg,
+            ],
+            cwd=dirname,
+        )
+        jpg_filesz = os.stat(asset_jpg).st_size
+        jpg_png_ratio = 1.0 * filesz / jpg_filesz
+        logger.debug("JPEG to PNG size ratio (more is better): %.1f" % jpg_png_ratio)
+        if jpg_png_ratio < 1.5:
+            # require at least 1.5 reduction, otherwise pointless
+            os.unlink(asset_jpg)
+        else:
+            # reduced size significantly -> use JPG
+            os.unlink(asset_dst)
+            fnout = fnjpg
+    return fnout
+
+
 def convert_images(md_text, dirname):
     """
     Parse through image references and convert all to png
@@ -133,37 +290,56 @@ def convert_images(md_text, dirname):
     3) Write a program with libUEMF. http://libuemf.sourceforge.net/
     """
 
-    a = re.split(
-        r"(?s)(!\[(?:[^\]]+)?\]\((?:\./)?media/[\w\.]+\.\w+\)(?:\{.*?\})?)", md_text
-    )
+    a = _RE_IMG_SPLIT.split(md_text)
+    refs = []  # (index, fnimg, fnpng) of every image reference
+    # Each png in assets is written once: fnpng -> [fnimg, w_px, h_px]
+    outputs = {}
+    for i, img_str in enumerate(a):
+        # text <img1> text <img2> text ...
+        if i % 2 == 0:
+            continue
+        if i == 1:
+            logger.info("Converting images")
+        fnimg, w_px, h_px = _parse_image(img_str)
+        logger.info("Processing %s (%dx%d)" % (fnimg, w_px, h_px))
+        fnpng = os.path.splitext(fnimg)[0] + ".png"
+        refs.append((i, fnimg, fnpng))
+        out = outputs.get(fnpng)
+        if out is None or out[0] != fnimg:
+            if out is not None:
+                # e.g. image1.png and image1.emf. The one referenced last wins,
+                # as it did when every reference was converted in turn
+                logger.warning("%s and %s both convert to %s" % (out[0], fnimg, fnpng))
+            outputs[fnpng] = [fnimg, w_px, h_px]
+        else:
+            # Same image referenced again, convert it at the largest size asked
+            out[1], out[2] = max(out[1], w_px), max(out[2], h_px)
+
+    converted = {}  # fnpng -> file written to assets, or None on failure
+    raster = []  # fnpng of the outputs made by imagemagick
+    vector = []  # fnpng of the outputs exported by Visio
+    for fnpng, (fnimg, w_px, h_px) in outputs.items():
+        if _RE_VECTOR_IMG.search(fnimg):
+            vector.append(fnpng)
+        else:
+            raster.append(fnpng)
+
     docsrv_started = False
     try:
-        for i, img_str in enumerate(a):
-            # text <img1> text <img2> text ...
-            if i % 2 == 0:
-                continue
-            if i == 1:
-                logger.info("Converting images")
-            m = re.search(
-                r'(?s)media/(.*)\).*width="(\S+?)in.*height="(\S+?)in', img_str
+        # imagemagick runs are independent external processes, so run them
+        # concurrently. Every output is converted once, so no two workers
+        # write the same file. map() submits everything up front, so Visio
+        # below works through its exports while these are running.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = executor.map(
+                lambda fnpng: _convert_one(*outputs[fnpng], dirname), raster
             )
-            if m:
-                fnimg, w_in, h_in = m.groups(1)
-            else:
-                fnimg, w_in, h_in = (
-                    re.search(r"(?s)media/(.*)\)", img_str).group(1),
-                    10,
-                    10,
-                )
-            ppi = 300  # Typical printer
-            # Maximum size we need our images to be
-            w_px, h_px = int(float(w_in) * ppi), int(float(h_in) * ppi)
-            logger.info("Processing %s (%dx%d)" % (fnimg, w_px, h_px))
 
-            fnpng = os.path.splitext(fnimg)[0] + ".png"
-            try:
-                if re.search(r"(?i)\.[ew]mf$", fnimg):
-                    # Use Visio to convert emf/wmf images
+            # Use Visio to convert emf/wmf images. There is only one docsrv
+            # session, so queue all the exports on it from this thread
+            for fnpng in vector:
+                fnimg = outputs[fnpng][0]
+                try:
                     if not docsrv_started:
                         docsrv.start_session()
                         docsrv_started = True
@@ -171,87 +347,24 @@ def convert_images(md_text, dirname):
                         "VISIO_EXPORT_PAGES_BY_NAME|media/%s|Page-1|assets/%s"
                         % (fnimg, fnpng)
                     )
-                    a[i] = re.sub(
-                        r"\(media/[^\)]+\)(?:\{.+?\})?", r"(assets/%s)" % fnpng, a[i]
-                    )
-                    continue
-                else:
-                    check_call(
-                        [
-                            magick,
-                            "media/%s" % fnimg,
-                            "-resize",
-                            "%dx%d>" % (w_px, h_px),
-                            "assets/%s" % fnpng,
-                        ],
-                        env=my_env,
-                        cwd=dirname,
-                    )
-            except Exception as e:
-                print("-E- Unable to convert %s to png: %s" % (fnimg, e))
-                a[i] = "[FIXME - failed to convert %s]()" % fnimg
-                continue
-            orig_filesz = os.stat(os.path.join(dirname, "media", fnimg)).st_size
-            filesz = os.stat(os.path.join(dirname, "assets", fnpng)).st_size
-            if (
-                fnimg.endswith("png") or fnimg.endswith("tmp")
-            ) and filesz > orig_filesz:
-                # Just copy over the PNG if size increased
-                copy2(
-                    os.path.join(dirname, "media", fnimg),
-                    os.path.join(dirname, "assets", fnpng),
-                )
+                    converted[fnpng] = fnpng
+                except Exception as e:
+                    print("-E- Unable to convert %s to png: %s" % (fnimg, e))
+                    converted[fnpng] = None
 
-            # Check if PNG format makes sense for large files. Some are better converted to JPG
-            fnout = fnpng
-            filesz = os.stat(os.path.join(dirname, "assets", fnpng)).st_size
-            ii = (
-                util.check_output_text(
-                    [magick, "identify", "assets/%s" % fnpng], env=my_env, cwd=dirname
-                )
-                .strip()
-                .split()
-            )
-            # image151.png PNG 3000x2250 3000x2250+0+0 8-bit sRGB 2.145MB 0.000u 0:00.000
-            w, h = list(map(int, ii[2].split("x")))
-            n_bytes_raw = w * h * 3
-            comp_ratio = 1.0 * n_bytes_raw / filesz
-            logger.debug(
-                "%s: %dkB, compression ratio: %.1f" % (fnpng, filesz / 1024, comp_ratio)
-            )
-            if filesz > 100000 and comp_ratio < 50:
-                # Big poorly compressed file - see if that's justified
-                logger.debug("Candidate image for compression: %s" % fnpng)
-                fnjpg = os.path.splitext(fnimg)[0] + ".jpg"
-                check_call(
-                    [
-                        magick,
-                        "assets/%s" % fnpng,
-                        "-resize",
-                        "1200>",
-                        "assets/%s" % fnjpg,
-                    ],
-                    cwd=dirname,
-                )
-                jpg_filesz = os.stat(os.path.join(dirname, "assets", fnjpg)).st_size
-                jpg_png_ratio = 1.0 * filesz / jpg_filesz
-                logger.debug(
-                    "JPEG to PNG size ratio (more is better): %.1f" % jpg_png_ratio
-                )
-                if jpg_png_ratio < 1.5:
-                    # require at least 1.5 reduction, otherwise pointless
-                    os.unlink(os.path.join(dirname, "assets", fnjpg))
-                else:
-                    # reduced size significantly -> use JPG
-                    os.unlink(os.path.join(dirname, "assets", fnpng))
-                    fnout = fnjpg
-            a[i] = re.sub(r"\(media/[^\)]+\)(?:\{.+?\})?", r"(assets/%s)" % fnout, a[i])
+            converted.update(zip(raster, results))
     finally:
         if docsrv_started:
             docsrv.end_session()
 
+    for i, fnimg, fnpng in refs:
+        if converted[fnpng]:
+            a[i] = _asset_ref(a[i], converted[fnpng])
+        else:
+            a[i] = "[FIXME - failed to convert %s]()" % fnimg
+
     result = "".join(a)
-    m = re.search(r"(?m)^(.*\(media/.*\.png\)).*$", result)
+    m = _RE_MEDIA_LEFT.search(result)
     if m:
         print("ERROR: not converted image\n%s" % m.group(1))
     elif not g.opts.debug:
@@ -266,54 +379,92 @@ def convert_images(md_text, dirname):
     return result
 
 
+_ENTITY_MAP = {
+    "&#160;": " ",  # Non-breaking space
+    "&#169;": "&copy;",  # COPYRIGHT SIGN
+    "&#174;": "&reg;",  # REGISTERED SIGN
+    "&#8216;": "'",  # LEFT SINGLE QUOTATION MARK
+    "&#8217;": "'",  # RIGHT SINGLE QUOTATION MARK
+    "&#8209;": "-",  # NON-BREAKING HYPHEN
+    "&#8211;": "-",  # EN DASH
+    "&#8220;": '"',  # LEFT DOUBLE QUOTATION MARK
+    "&#8221;": '"',  # RIGHT DOUBLE QUOTATION MARK
+    "&#8230;": "...",  # HORIZONTAL ELLIPSIS
+}
+
+
 def clean_utf8(s):
-    s = s.replace("&#160;", " ")  # Non-breaking space
-    s = s.replace("&#169;", "&copy;")  # COPYRIGHT SIGN
-    s = s.replace("&#174;", "&reg;")  # REGISTERED SIGN
-    s = s.replace("&#8216;", "'")  # LEFT SINGLE QUOTATION MARK
-    s = s.replace("&#8217;", "'")  # RIGHT SINGLE QUOTATION MARK
-    s = s.replace("&#8209;", "-")  # NON-BREAKING HYPHEN
-    s = s.replace("&#8211;", "-")  # EN DASH
-    s = s.replace("&#8220;", '"')  # LEFT DOUBLE QUOTATION MARK
-    s = s.replace("&#8221;", '"')  # RIGHT DOUBLE QUOTATION MARK
-    s = s.replace("&#8230;", "...")  # HORIZONTAL ELLIPSIS
+    # Single pass over the text for all the entities we care about
+    s = _RE_ENTITIES.sub(lambda m: _ENTITY_MAP[m.group(0)], s)
     s = s.replace("\r\n", "\n")  # Windows -> Unix
     s = s.replace("\r\n", "\n\n")  # Second pass for \r\r\n cases
     return s
 
 
 def clean_tags(s):
-    cleanup_needed = 1
-    while cleanup_needed:
-        # Remove empty spans
-        s, cleanup_needed = re.subn(r"(?ms)<span[^>]*>\s*</span>", "", s)
+    # Remove empty spans, including the ones that only wrap other empty spans.
+    # Track the open spans on a stack so this takes a single pass over the text
+    out = []
+    stack = []  # [index of the opening tag in out, span has content]
+    pos = 0
+    for m in _RE_SPAN_TAG.finditer(s):
+        text = s[pos : m.start()]
+        out.append(text)
+        if stack and text.strip():
+            stack[-1][1] = True
+        pos = m.end()
+        tag = m.group(0)
+        if tag != "</span>":
+            stack.append([len(out), False])
+            out.append(tag)
+        elif not stack:
+            # Unbalanced closing tag, leave it alone
+            out.append(tag)
+        else:
+            start, has_content = stack.pop()
+            if has_content:
+                out.append(tag)
+                if stack:
+                    stack[-1][1] = True
+            else:
+                del out[start:]
+    out.append(s[pos:])
+    s = "".join(out)
     # clean up empty comments (they serve some purpose but all
     # usages I've seen were bogus)
-    s = re.sub(r"(?sm)<!--\s*-->", "", s)
+    s = _RE_COMMENT.sub("", s)
     return s
 
 
 def clean_backslashes(s):
     # Pandoc is smart enough to ignore underscores, bracketed indices, etc.
     # So for readability, we'll remove the escaping
-    a = re.split(r"(\$\$.*?\$\$)", s)  # (except for undescores in formulas)
-    a = [re.sub(r"(\w)\\_", r"\1_", x) if i % 2 == 0 else x for i, x in enumerate(a)]
-    s = "".join(a)
-    s = re.sub(r"\\\[(\d+\:\d+)\\\]", r"[\1]", s)
-    s = re.sub(r"\\~", r"~", s)
+    # (expects text without formulas, see with_math_guard)
+    s = _RE_ESC_US.sub(r"\1_", s)
+    s = _RE_ESC_IDX.sub(r"[\1]", s)
+    s = _RE_ESC_TILDE.sub(r"~", s)
     return s
 
 
+def with_math_guard(s, fn):
+    """
+    Apply fn to everything outside of $$...$$ formulas, leaving those intact
+    """
+    a = _RE_MATH.split(s)
+    a[::2] = [fn(x) for x in a[::2]]
+    return "".join(a)
+
+
 def clean_markdown(s):
     # Remove empty list items
-    s = re.sub(r"(?m)^\d+\.\s*$", "", s)
-    s = re.sub(r"(?m)^-\s*$", "", s)
+    s = _RE_EMPTY_OL.sub("", s)
+    s = _RE_EMPTY_UL.sub("", s)
     # Remove empty/bogus tables
-    s = re.sub(r"(?ms)^\s*\n(?:\s+-+)+\n\s*\n(?:\s+-+)+\n\s*$", "", s)
+    s = _RE_EMPTY_TBL.sub("", s)
     # clean up spaces at EOL
-    s = re.sub(r"(?m)\s+\n", "\n", s)
+    s = _RE_EOL_WS.sub("\n", s)
     # Collapse adjacent empty lines
-    s = re.sub(r"\n{3,}", "\n\n", s)
+    s = _RE_BLANKS.sub("\n\n", s)
     return s
 
 
@@ -323,19 +474,20 @@ def tablefix(md_text, basename):
     markdown or xls as appropriate
     """
 
-    token_specification = []
-    # TODO: regex to tolerate nested tables
-    token_specification.append(("HTML_TABLE", "<table>.*?</table>"))
-    token_specification.append(("TEXT", r"."))  # anything else
-    T = util.Tokenizer(token_specification)
-
-    output_text = ""
+    # text <table1> text <table2> text ...
+    parts = _RE_TABLE_SPLIT.split(md_text)
 
     xlpath = "assets/%s.xlsx" % basename
 
     def init_xls_wb():
         logger.info("Converting tables to %s.xlsx" % basename)
-        wb = xlsxwriter.Workbook(xlpath, {"strings_to_formulas": False})
+        wb = xlsxwriter.Workbook(
+            xlpath,
+            {
+                "strings_to_formulas": False,
+                "constant_memory": not spans_rows(parts[1::2]),
+            },
+        )
         formats = {
             "merge": wb.add_format(
                 {"align": "center", "border": True, "text_wrap": True}
@@ -354,30 +506,49 @@ def tablefix(md_text, basename):
         return wb, formats
 
     wb = None
-    for token in T.tokenize(md_text):
-        if token.typ == "HTML_TABLE":
-            if not wb:
-                wb, formats = init_xls_wb()
-            table = html2table(token.value, wb, formats)
-            if isinstance(table, str):
-                output_text += "\n"
-                output_text += table
-                output_text += "\n"
-            else:
-                # Must have been xlsx
-                sheetname = table.get_name()
-                caption = table.full_name.replace('"', "'")
-                output_text += '\n```xls("%s", "%s", "%s")\n```\n\n' % (
-                    xlpath,
-                    sheetname,
-                    caption,
-                )
+    for i in range(1, len(parts), 2):
+        if not wb:
+            wb, formats = init_xls_wb()
+        table = html2table(parts[i], wb, formats)
+        if isinstance(table, str):
+            parts[i] = "\n%s\n" % table
         else:
-            output_text += token.value
+            # Must have been xlsx
+            sheetname = table.get_name()
+            caption = table.full_name.replace('"', "'")
+            parts[i] = '\n```xls("%s", "%s", "%s")\n```\n\n' % (
+                xlpath,
+                sheetname,
+                caption,
+            )
 
     if wb:
         wb.close()
-    return output_text
+    return "".join(parts)
+
+
+# Only the rows and the caption of a table are ever looked at
+_TABLE_STRAINER = bs4.SoupStrainer(["tr", "caption"])
+
+
+def spans_rows(tables):
+    """
+    Check if any of the HTML tables may have a cell spanning rows
+
+    constant_memory mode flushes each row to disk once the next one is started.
+    merge_range() writes blanks into the rows below a rowspan, which would flush
+    and drop the rest of the current row, so that mode is only safe without them.
+    Errs on the side of True for anything that doesn't read as rowspan="1".
+    """
+    for html in tables:
+        for m in _RE_ROWSPAN.finditer(html):
+            value = next(v for v in m.groups() if v is not None)
+            try:
+                if int(value) > 1:
+                    return True
+            except ValueError:
+                return True
+    return False
 
 
 class TableBetterForExcel(Exception):
@@ -388,7 +559,7 @@ def html2table(html, wb, formats):
     """
     Parse HTML and write to xlsx worksheet
     """
-    s = bs4.BeautifulSoup(html, "html.parser")
+    s = bs4.BeautifulSoup(html, "lxml", parse_only=_TABLE_STRAINER)
 
     # First look to see if this is a simple table.  if it is, return markdown
     # - no newlines
@@ -433,20 +604,9 @@ def fit_columns(sheet, colwidth):
     """
     colsum = 9999
     while colsum > 190:
-        maxcol = 0
-        maxcol_i = -1
-        for i in range(len(colwidth)):
-            if colwidth[i] > maxcol:
-                maxcol = colwidth[i]
-                maxcol_i = i
-        threshold = maxcol * 0.9
-        for i in range(len(colwidth)):
-            if colwidth[i] >= threshold:
-                colwidth[i] = colwidth[i] * 0.7
-
-        colsum = 0
-        for c in colwidth:
-            colsum += c
+        threshold = max(colwidth, default=0) * 0.9
+        colwidth[:] = [c * 0.7 if c >= threshold else c for c in colwidth]
+        colsum = sum(colwidth)
 
     for i in range(len(colwidth)):
         # Add char width to the columns to cover for some variation in character
@@ -475,12 +635,12 @@ def write_cells(sheet, s, formats):
 
     skip_merged = set()
 
-    for row in s.findAll("tr"):
+    for row in s.find_all("tr"):
         header = False
-        cols = row.findAll("td")
+        cols = row.find_all("td")
         if len(cols) == 0:
             header = True
-            cols = row.findAll("th")
+            cols = row.find_all("th")
             if len(cols) == 0:
                 continue
         x = 0
@@ -529,14 +689,13 @@ def write_cells(sheet, s, formats):
                         skip_merged.add((x + cs, y + rs))
 
                 # Find the longest line and divide by the number of columns
-                width = len(max(data.text.split("\n"), key=len))
+                width = max(map(len, data.text.split("\n")))
                 for cs in range(colspan):
                     colwidth[x + cs] = max(colwidth.get(x + cs, 0), width / colspan)
             else:
-                # Trick -- the max function will find the longest full line in the list and then the
-                # len() wrapper finds the character count.
+                # Character count of the longest line
                 colwidth[x] = max(
-                    colwidth.get(x, 0), len(max(cell_text.split("\n"), key=len))
+                    colwidth.get(x, 0), max(map(len, cell_text.split("\n")))
                 )
 
                 if header:
@@ -556,17 +715,17 @@ def markdown_table(s):
     """
     header = []
     table = []
-    rowlen = 0
-    for row in s.findAll("tr"):
+    for row in s.find_all("tr"):
         isheader = False
-        cols = row.findAll("td")
+        cols = row.find_all("td")
         if len(cols) == 0:
             isheader = True
-            cols = row.findAll("th")
+            cols = row.find_all("th")
             if len(cols) == 0:
                 continue
         x = 0
         row = []
+        rowlen = 0
         for data in cols:
             rowspan = 1
             colspan = 1
@@ -586,16 +745,17 @@ def markdown_table(s):
 
             if cell == "":
                 cell = "&nbsp;"
+
+            # check max row size
+            rowlen += len(cell)
+            if rowlen > 100:
+                raise TableBetterForExcel
             row.append(cell)
         if isheader:
             header = row
         else:
             table.append(row)
 
-        # check max row size
-        if len("".join(row)) > 100:
-            raise TableBetterForExcel
-
     ans = tabulate(table, headers=header)
     if s.caption:
         ans = ans.rstrip() + "\n\nTable: %s\n" % s.caption.text.strip()
@@ -604,7 +764,8 @@ def markdown_table(s):
 
 if __name__ == "__main__":
     try:
-        # log usage details
+        # log usage details. Left synchronous: wrapping it in a daemon thread
+        # would also make the thread it starts a daemon, losing the report at exit
         util.log_app_details_async(command=" ".join(sys.argv[0:]))
 
         parser = setup_parser()
@@ -634,9 +795,9 @@ if __name__ == "__main__":
         md_text = docx2mmd(source_path, output_path)
         md_text = convert_images(md_text, output_path)
         md_text = move_embeddings(md_text, output_path)
-        md_text = clean_utf8(md_text)
-        md_text = clean_tags(md_text)
-        md_text = clean_backslashes(md_text)
+        md_text = with_math_guard(
+            md_text, lambda x: clean_backslashes(clean_tags(clean_utf8(x)))
+        )
 
         # Post-process the markdown text and replace tables
         md_text = tablefix(md_text, base_name)